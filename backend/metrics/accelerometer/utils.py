@@ -1,14 +1,18 @@
 from datetime import datetime
 
+# Pre-selected formats: dispatching on string length avoids raising and
+# catching a ValueError (and a second strptime format parse) on every call
+_FMT_DATETIME = "%Y-%m-%d %H:%M:%S"
+_FMT_DATE = "%Y-%m-%d"
+
 def date_parser(date_str):
     """
     Basic simulation of the date_parser function of the accelerometer package.
     Adjust the format according to the type of dates you are handling.
     """
-    try:
-        return datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
-    except ValueError:
-        try:
-            return datetime.strptime(date_str, "%Y-%m-%d")
-        except ValueError:
-            raise ValueError(f"Unsupported date format: {date_str}")
\ No newline at end of file
+    n = len(date_str)
+    if n == len(_FMT_DATETIME) + 2:  # "YYYY-MM-DD HH:MM:SS" -> 19 chars
+        return datetime.strptime(date_str, _FMT_DATETIME)
+    if n == len(_FMT_DATE) + 2:  # "YYYY-MM-DD" -> 10 chars
+        return datetime.strptime(date_str, _FMT_DATE)
+    raise ValueError(f"Unsupported date format: {date_str}")
@@ -1,26 +1,96 @@
+import asyncio
 import os
+from contextlib import asynccontextmanager
+
+import asyncpg
 import pandas as pd
 import numpy as np
-import json
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from postgrest import AsyncPostgrestClient
 from .main import process_sleep_record
 
 URL = os.getenv("SUPABASE_URL") + "/rest/v1/"
 KEY = os.getenv("SUPABASE_SERVICE_KEY")
-supabase = AsyncPostgrestClient(URL, headers={
-    "apikey": KEY,
-    "Authorization": f"Bearer {KEY}"
-})
-supabase.auth(KEY)
+DB_URL = os.getenv("SUPABASE_DB_URL")  # optional direct Postgres DSN
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One PostgREST client per process: its underlying httpx connection pool
+    # keeps connections alive across requests, so the TLS handshake is paid
+    # once instead of per call, and the client is closed cleanly on shutdown
+    app.state.pg = AsyncPostgrestClient(URL, headers={
+        "apikey": KEY,
+        "Authorization": f"Bearer {KEY}"
+    }, timeout=30)
+    app.state.pg.auth(KEY)
+
+    # Optional fast path: when SUPABASE_DB_URL is set, raw sensor reads go
+    # straight to Postgres through an asyncpg pool. The binary protocol skips
+    # the PostgREST hop and the per-row JSON encode/decode of REST responses.
+    app.state.pool = None
+    if DB_URL:
+        app.state.pool = await asyncpg.create_pool(
+            DB_URL,
+            min_size=10,
+            max_size=50,
+            max_inactive_connection_lifetime=300,
+        )
+    yield
+    await app.state.pg.aclose()
+    if app.state.pool is not None:
+        await app.state.pool.close()
 
 class Payload(BaseModel):
     sleep_record_id: int
 
-app = FastAPI()
+class BatchPayload(BaseModel):
+    sleep_record_ids: list[int]
+
+# ORJSONResponse serialises responses with orjson (C implementation that also
+# understands NumPy scalars), skipping the slow jsonable_encoder + json.dumps path
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 @app.post("/compute")
-async def compute(payload: Payload):
-    await process_sleep_record(payload.sleep_record_id, supabase)
+async def compute(payload: Payload, request: Request):
+    await process_sleep_record(payload.sleep_record_id, request.app.state.pg,
+                               pool=request.app.state.pool)
     return {"status": "ok"}
+
+@app.post("/compute_batch")
+async def compute_batch(payload: BatchPayload, request: Request):
+    # One bulk SELECT with .in_() replaces a pair of round trips per record;
+    # rows come back globally ordered by captured_at, so each record's slice
+    # is already sorted the way process_sleep_record expects. The direct
+    # Postgres pool keeps its own parallel per-record fetches, which are
+    # cheaper than shipping the whole batch through one REST response
+    grouped = None
+    if request.app.state.pool is None:
+        resp = await (request.app.state.pg.from_("raw_sensor_data")
+                      .select("sleep_record_id,sensor_type,value,captured_at")
+                      .in_("sleep_record_id", payload.sleep_record_ids)
+                      .order("captured_at")
+                      .execute())
+        grouped = {rid: ([], []) for rid in payload.sleep_record_ids}
+        for row in resp.data:
+            accel_rows, hr_rows = grouped[row["sleep_record_id"]]
+            if row["sensor_type"] == "accelerometer":
+                accel_rows.append({"value": row["value"], "captured_at": row["captured_at"]})
+            elif row["sensor_type"] == "heart_rate":
+                hr_rows.append({"value": row["value"], "captured_at": row["captured_at"]})
+
+    # Records are independent, so process them concurrently: gather overlaps
+    # the fetch and insert round trips of every record, while the semaphore
+    # caps how many pipelines crunch numbers at once so a large recalculation
+    # doesn't starve the event loop or the database
+    sem = asyncio.Semaphore(8)
+
+    async def run(rec_id: int):
+        async with sem:
+            await process_sleep_record(rec_id, request.app.state.pg,
+                                       pool=request.app.state.pool,
+                                       prefetched=None if grouped is None else grouped[rec_id])
+
+    await asyncio.gather(*(run(r) for r in payload.sleep_record_ids))
+    return {"status": "ok", "processed": len(payload.sleep_record_ids)}